@@ -5,13 +5,23 @@ except ImportError:
 
 from .config import print_config, setup
 from .helpers import track_exit
-from .operations import add_breadcrumb, check_project, get_usage
+from .operations import (
+    add_breadcrumb,
+    add_breadcrumb_async,
+    check_project,
+    check_project_async,
+    get_usage,
+    get_usage_async,
+)
 
 __all__ = (
     "__version__",
     "add_breadcrumb",
+    "add_breadcrumb_async",
     "check_project",
+    "check_project_async",
     "get_usage",
+    "get_usage_async",
     "print_config",
     "setup",
     "track_exit",
@@ -4,9 +4,10 @@ import os
 import typing
 import uuid
 from dataclasses import dataclass, fields
-from functools import wraps
+from functools import lru_cache, wraps
 from pathlib import Path
 from tempfile import gettempdir
+from types import MappingProxyType
 
 from .utils import compile_info
 
@@ -115,6 +116,7 @@ class Config:
 
         If class was already configured, existing configuration is used.
         """
+        _fingerprint.cache_clear()
         if cls._pid is None:
             cls._pid = os.getpid()
         cls.endpoint = endpoint or DEFAULT_ENDPOINT
@@ -167,12 +169,23 @@ class Config:
     @classmethod
     def _reset(cls) -> None:
         """Reset the config class attributes."""
+        _fingerprint.cache_clear()
         cls.endpoint = None
         cls.user_id = None
         cls.session_id = None
         cls._is_setup = False
 
 
+@lru_cache(maxsize=None)
+def _fingerprint() -> MappingProxyType:
+    """
+    Read-only snapshot of `Config.populate()`.
+
+    The snapshot is cleared whenever `Config` is initialized or reset.
+    """
+    return MappingProxyType(Config.populate())
+
+
 def setup(
     *,
     endpoint: str = None,
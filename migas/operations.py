@@ -3,49 +3,302 @@ Create queries and mutations to be sent to the graphql endpoint.
 """
 from __future__ import annotations
 
-import dataclasses
+import asyncio
+import atexit
 import enum
-import json
+import functools
+import inspect
+import logging
+import os
+import queue
+import threading
+import time
 import typing as ty
 import warnings
+from types import MappingProxyType
 
-from migas.config import Config, logger, telemetry_enabled
-from migas.request import request
+from migas.config import Config, _fingerprint, logger, telemetry_enabled
+from migas.request import TIMEOUT_RESPONSE, UNAVAIL_RESPONSE, request
+from migas.utils import json_dumps
 
 class QueryParamType(enum.Enum):
     LITERAL = enum.auto()
     TEXT = enum.auto()
 
 ERROR = '[migas-py] An error occurred.'
+_DEFAULT_FALLBACK = MappingProxyType({'success': False, 'message': ERROR})
+# status codes of requests that did not reach the server
+_TRANSPORT_ERRORS = (TIMEOUT_RESPONSE[0], UNAVAIL_RESPONSE[0])
+
+
+# emitter opcodes: nested input delimiters, and arguments by parameter type
+_OPEN, _CLOSE, _LITERAL, _TEXT = range(4)
+_OPCODES = {
+    QueryParamType.LITERAL: _LITERAL,
+    QueryParamType.TEXT: _TEXT,
+}
+
+
+def _format_literal(val: ty.Any) -> str:
+    return str(val).lower() if isinstance(val, bool) else str(val)
+
+
+def _format_text(val: ty.Any) -> str:
+    if isinstance(val, bool):
+        val = str(val).lower()
+    # printable ASCII strings without quotes or backslashes are encoded as is
+    if type(val) is str and val.isascii() and val.isprintable():
+        if '"' not in val and '\\' not in val:
+            return '"' + val + '"'
+    return json_dumps(val)
+
+
+_FORMATTERS: dict[int, ty.Callable[[ty.Any], str]] = {
+    _LITERAL: _format_literal,
+    _TEXT: _format_text,
+}
+
+
+def _compile_emitters(query_args: dict) -> list[tuple[int, str]]:
+    """
+    Flatten the query arguments into a list of `(opcode, argument)` emitters.
+
+    Nested inputs are surrounded by `_OPEN` / `_CLOSE` emitters.
+    """
+    emitters = []
+    for qarg, qval in query_args.items():
+        if isinstance(qval, dict):
+            emitters.append((_OPEN, qarg))
+            emitters.extend(_compile_emitters(qval))
+            emitters.append((_CLOSE, qarg))
+        elif qval in _OPCODES:
+            emitters.append((_OPCODES[qval], qarg))
+        else:
+            raise TypeError(f'Do not know how to handle type {qval} of argument "{qarg}"')
+    return emitters
+
+
+def _compile_template(emitters: list[tuple[int, str]], keys: frozenset[str]) -> str:
+    """
+    Create a `str.format` template of the query arguments.
+
+    Only arguments within `keys` are included, while nested inputs are always present.
+    """
+    parts: list[str] = []
+    sep = ''
+    for opcode, qarg in emitters:
+        if opcode == _OPEN:
+            parts.append(f'{sep}{qarg}:{{{{')
+            sep = ''
+        elif opcode == _CLOSE:
+            parts.append('}}')
+            sep = ','
+        elif qarg in keys:
+            parts.append(f'{sep}{qarg}:{{{qarg}}}')
+            sep = ','
+    return ''.join(parts)
 
 
-@dataclasses.dataclass
 class Operation:
-    operation_type: str
-    operation_name: str
-    query_args: dict
-    selections: tuple | None = None  # TODO: Add subfield selection support
-    query: str = ''
-    fingerprint: bool = False
-    error_response: dict | None = None
+    """Base graphql operation, defined through class attributes and never instantiated."""
+
+    operation_type: ty.ClassVar[str]
+    operation_name: ty.ClassVar[str]
+    query_args: ty.ClassVar[dict]
+    selections: ty.ClassVar[tuple | None] = None  # TODO: Add subfield selection support
+    fingerprint: ty.ClassVar[bool] = False
+    error_response: ty.ClassVar[dict | None] = None
+    _emitters: ty.ClassVar[list[tuple[int, str]]]
+    _formatters: ty.ClassVar[dict[str, ty.Callable[[ty.Any], str]]]
+    _templates: ty.ClassVar[dict[frozenset[str], str]]
+    _query_prefix: ty.ClassVar[str]
+    _query_suffix: ty.ClassVar[str]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # flattened arguments and their formatters, and argument templates keyed by
+        # provided arguments
+        cls._emitters = _compile_emitters(cls.query_args)
+        cls._formatters = {
+            qarg: _FORMATTERS[opcode] for opcode, qarg in cls._emitters if opcode in _FORMATTERS
+        }
+        cls._templates = {}
+        # static query text surrounding the arguments
+        selections = f'{{{",".join(cls.selections)}}}' if cls.selections else ''
+        cls._query_prefix = f'{cls.operation_type}{{{cls.operation_name}('
+        cls._query_suffix = f'){selections}}}'
 
     @classmethod
     def generate_query(cls, *args, **kwargs) -> str:
         parameters = _introspec(cls.generate_query, locals())
-        params = Config.populate() if cls.fingerprint else {}
+        params = _fingerprint() if cls.fingerprint else {}
         params = {**params, **kwargs, **parameters}
         query = cls._construct_query(params)
         return query
 
     @classmethod
-    def _construct_query(cls, params: dict) -> str:
+    def _construct_query(cls, params: dict[str, ty.Any]) -> str:
         """Construct the graphql query."""
-        query = _parse_format_params(params, cls.query_args)
-        cls.query = f'{cls.operation_type}{{{cls.operation_name}({query})'
-        if cls.selections:
-            cls.query += f'{{{",".join(f for f in cls.selections)}}}'
-        cls.query += '}'
-        return cls.query
+        formatters = cls._formatters
+        keys = frozenset(arg for arg in formatters if arg in params)
+        template = cls._templates.get(keys)
+        if template is None:
+            template = cls._templates[keys] = _compile_template(cls._emitters, keys)
+        query = template.format_map({arg: formatters[arg](params[arg]) for arg in keys})
+        return ''.join((cls._query_prefix, query, cls._query_suffix))
+
+    @classmethod
+    def _alias_queries(cls, queries: list[str]) -> str:
+        """Combine queries of this operation into a single document, aliased by their index."""
+        start = len(cls.operation_type) + 1
+        fields = ' '.join(f'q{idx}:{query[start:-1]}' for idx, query in enumerate(queries))
+        return f'{cls.operation_type}{{{fields}}}'
+
+
+class _TelemetryQueue:
+    """
+    Queue of operation queries, which are coalesced and sent by a background thread.
+
+    Queries are batched into a single aliased document, sent once either `max_size` queries
+    are pending or `interval` seconds have passed since the first pending query.
+    """
+
+    def __init__(
+        self,
+        operation: type[Operation],
+        max_size: int = 20,
+        interval: float = 1.0,
+        flush_timeout: float = 5.0,
+    ):
+        self.operation = operation
+        self.max_size = max_size
+        self.interval = interval
+        self.flush_timeout = flush_timeout
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        """Start with an empty queue and no background thread, as needed in a forked child."""
+        self._pid = os.getpid()
+        self._queue: queue.SimpleQueue[str] = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        # number of queued queries that have not yet been sent
+        self._pending = 0
+        self._done = threading.Condition()
+
+    def put(self, query: str) -> None:
+        if self._pid != os.getpid():
+            self._reset()
+        with self._done:
+            self._pending += 1
+        self._queue.put(query)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='migas-telemetry', daemon=True
+                    )
+                    self._thread.start()
+
+    def flush(self) -> None:
+        """Send all pending queries, and wait up to `flush_timeout` for an in-flight batch."""
+        if self._pid != os.getpid():
+            # queries queued by the parent process are left to the parent
+            self._reset()
+            return
+        queries = []
+        while True:
+            try:
+                queries.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for idx in range(0, len(queries), self.max_size):
+            self._send(queries[idx : idx + self.max_size])
+        with self._done:
+            self._done.wait_for(lambda: self._pending <= 0, timeout=self.flush_timeout)
+
+    def _run(self) -> None:
+        while True:
+            queries = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(queries) < self.max_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    queries.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._send(queries)
+
+    def _send(self, queries: list[str]) -> None:
+        try:
+            status, response = request(
+                Config.endpoint, query=self.operation._alias_queries(queries)
+            )
+            if len(queries) > 1 and _is_validation_error(status, response):
+                # an invalid query fails the entire document, so retry individually
+                for query in queries:
+                    status, response = request(Config.endpoint, query=query)
+                    _check_response(response, self.operation.operation_name)
+                    if status in _TRANSPORT_ERRORS:
+                        break
+                return
+            for idx in range(len(queries)):
+                _check_response(response, f'q{idx}')
+        except Exception as e:
+            logger.debug('Failed to send queued telemetry: %s', e)
+        finally:
+            with self._done:
+                self._pending -= len(queries)
+                self._done.notify_all()
+
+
+def _ttl_cache(seconds: float) -> ty.Callable:
+    """
+    Decorator to reuse successful responses of an operation for `seconds`.
+
+    Responses are keyed by the endpoint and the operation inputs.
+    """
+
+    def decorator(func: ty.Callable) -> ty.Callable:
+        cache: dict[ty.Hashable, tuple[float, dict]] = {}
+        # operations may run concurrently, e.g. from the asynchronous variants
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def cached(*args, **kwargs) -> dict:
+            key = (Config.endpoint, args, frozenset(kwargs.items()))
+            try:
+                hash(key)
+            except TypeError:
+                # unhashable inputs are not cached
+                return func(*args, **kwargs)
+
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(key)
+            if hit is not None and hit[0] > now:
+                return dict(hit[1])
+
+            res = func(*args, **kwargs)
+            with lock:
+                for k in [k for k, (expiry, _) in cache.items() if expiry <= now]:
+                    del cache[k]
+                if isinstance(res, dict) and res.get('success'):
+                    cache[key] = (now + seconds, dict(res))
+            return res
+
+        def cache_clear() -> None:
+            with lock:
+                cache.clear()
+
+        cached.cache_clear = cache_clear
+        return cached
+
+    return decorator
 
 
 class AddBreadcrumb(Operation):
@@ -75,6 +328,11 @@ class AddBreadcrumb(Operation):
     selections = ('success',)
 
 
+_breadcrumbs = _TelemetryQueue(AddBreadcrumb)
+# registered on import, so pending breadcrumbs are flushed after any `track_exit` breadcrumb
+atexit.register(_breadcrumbs.flush)
+
+
 @telemetry_enabled
 def add_breadcrumb(project: str, project_version: str, **kwargs) -> dict:
     """
@@ -99,6 +357,10 @@ def add_breadcrumb(project: str, project_version: str, **kwargs) -> dict:
         - `container` (auto-detected)
         - `is_ci` (auto-detected)
 
+    If the `MIGAS_BATCH` environment variable is set, the breadcrumb is queued and sent
+    alongside others from a background thread, and a successful response is returned
+    immediately.
+
     Returns
     -------
     response: dict
@@ -107,10 +369,11 @@ def add_breadcrumb(project: str, project_version: str, **kwargs) -> dict:
     query = AddBreadcrumb.generate_query(
         project=project, project_version=project_version, **kwargs
     )
-    logger.debug(query)
-    _, response = request(Config.endpoint, query=query)
-    res = _filter_response(response, AddBreadcrumb.operation_name, AddBreadcrumb.error_response)
-    return res
+    if os.getenv("MIGAS_BATCH"):
+        logger.debug('Queued %s', query)
+        _breadcrumbs.put(query)
+        return {'success': True}
+    return _submit(AddBreadcrumb, query)
 
 
 class AddProject(Operation):
@@ -168,10 +431,7 @@ def add_project(project: str, project_version: str, **kwargs) -> dict:
         stacklevel=2,
     )
     query = AddProject.generate_query(project=project, project_version=project_version, **kwargs)
-    logger.debug(query)
-    _, response = request(Config.endpoint, query=query)
-    res = _filter_response(response, AddProject.operation_name, AddProject.error_response)
-    return res
+    return _submit(AddProject, query)
 
 
 class CheckProject(Operation):
@@ -197,6 +457,7 @@ class CheckProject(Operation):
 
 
 @telemetry_enabled
+@_ttl_cache(seconds=60)
 def check_project(project: str, project_version: str, **kwargs) -> dict:
     """
     Check a project version with the latest available.
@@ -204,16 +465,15 @@ def check_project(project: str, project_version: str, **kwargs) -> dict:
     This can be used to check for the most recent version, as well as if
     the `project_version` has been flagged by developers.
 
+    Successful responses are reused for 60 seconds.
+
     Returns
     -------
     response: dict
         keys: success, flagged, latest, message
     """
     query = CheckProject.generate_query(project=project, project_version=project_version, **kwargs)
-    logger.debug(query)
-    _, response = request(Config.endpoint, query=query)
-    res = _filter_response(response, CheckProject.operation_name)
-    return res
+    return _submit(CheckProject, query)
 
 
 class GetUsage(Operation):
@@ -228,67 +488,91 @@ class GetUsage(Operation):
 
 
 @telemetry_enabled
+@_ttl_cache(seconds=60)
 def get_usage(project: str, start: str, **kwargs) -> dict:
     query = GetUsage.generate_query(project=project, start=start, **kwargs)
-    logger.debug(query)
-    _, response = request(Config.endpoint, query=query)
-    res = _filter_response(response, GetUsage.operation_name)
-    return res
+    return _submit(GetUsage, query)
 
 
-def _introspec(func: ty.Callable, func_locals: dict) -> dict:
-    """Inspect a function and return all parameters (not defaults)."""
-    import inspect
+# `add_project` is deprecated, and intentionally has no asynchronous variant
+async def add_breadcrumb_async(project: str, project_version: str, **kwargs) -> dict:
+    """Asynchronous variant of `add_breadcrumb`."""
+    return await _run_in_executor(add_breadcrumb, project, project_version, **kwargs)
+
+
+async def check_project_async(project: str, project_version: str, **kwargs) -> dict:
+    """Asynchronous variant of `check_project`."""
+    return await _run_in_executor(check_project, project, project_version, **kwargs)
+
 
-    sig = inspect.signature(func)
+async def get_usage_async(project: str, start: str, **kwargs) -> dict:
+    """Asynchronous variant of `get_usage`."""
+    return await _run_in_executor(get_usage, project, start, **kwargs)
+
+
+async def _run_in_executor(func: ty.Callable, *args, **kwargs) -> dict:
+    """Run a blocking operation in the event loop's default executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+@functools.lru_cache(maxsize=None)
+def _signature_defaults(func: ty.Callable) -> tuple[tuple[str, ty.Any], ...]:
+    """Return the (name, default) pairs of a function's parameters, excluding `kwargs`."""
+    return tuple(
+        (param, val.default)
+        for param, val in inspect.signature(func).parameters.items()
+        if param != "kwargs"
+    )
+
+
+def _introspec(func: ty.Callable, func_locals: dict[str, ty.Any]) -> dict[str, ty.Any]:
+    """Inspect a function and return all parameters (not defaults)."""
     return {
         param: func_locals[param]
-        for param, val in sig.parameters.items()
-        if func_locals[param] != val.default and param != "kwargs"
+        for param, default in _signature_defaults(func)
+        if func_locals[param] != default
     }
 
 
-def _filter_response(response: dict | str, operation: str, fallback: dict | None = None):
-    if not fallback:
-        fallback = {
-            'success': False,
-            'message': ERROR,
-        }
+def _submit(operation: type[Operation], query: str) -> dict:
+    """Send an operation's query to the server, and return the operation response."""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(query)
+    # mutations carry per-user context and are rarely repeated, so only queries are persisted
+    _, response = request(
+        Config.endpoint, query=query, persisted=operation.operation_type == 'query'
+    )
+    return _filter_response(response, operation.operation_name, operation.error_response)
+
+
+def _filter_response(response: dict | str, operation: str, fallback: dict | None = None) -> dict:
+    default: ty.Mapping = fallback or _DEFAULT_FALLBACK
 
     if isinstance(response, dict):
         res = response.get("data")
         # success
         if isinstance(res, dict):
-            return res.get(operation, fallback)
+            if operation in res:
+                return res[operation]
+            return dict(default)
 
-    # Otherwise data is None, return fallback response with error reported
-    try:
-        fallback['message'] = response.get('errors')[0]['message']
-    finally:
-        return fallback
+        # Otherwise data is None, return fallback response with error reported
+        errors = response.get("errors")
+        if errors:
+            return {**default, 'message': errors[0].get('message', ERROR)}
+    # copied, so callers never share or modify the default responses
+    return dict(default)
 
 
-def _parse_format_params(params: dict, query_args: dict) -> str:
-    query_inputs = []
-    vals = None
+def _is_validation_error(status: int, response: dict | str) -> bool:
+    """Whether a reachable server rejected the query, rather than the request failing."""
+    if status in _TRANSPORT_ERRORS or not isinstance(response, dict):
+        return False
+    return not isinstance(response.get('data'), dict) and bool(response.get('errors'))
 
-    for qarg, qval in query_args.items():
-        if qarg in params:
-            val = params[qarg]
-            if isinstance(val, bool):
-                val = str(val).lower()
-
-            if qval.name == 'TEXT':
-                fval = json.dumps(val)
-            elif qval.name == 'LITERAL':
-                fval = val
-            else:
-                logger.error('Do not know how to handle type %s', qval.name)
-                fval = ''
-            query_inputs.append(f'{qarg}:{fval}')
-
-        elif isinstance(qval, dict):
-            vals = _parse_format_params(params, qval)
-            query_inputs.append(f'{qarg}:{{{vals}}}')
-
-    return ','.join(query_inputs)
+
+def _check_response(response: dict | str, operation: str) -> None:
+    res = _filter_response(response, operation)
+    if not (isinstance(res, dict) and res.get('success')):
+        logger.debug('Queued telemetry was not accepted: %s', res)
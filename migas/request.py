@@ -1,13 +1,15 @@
 """Stripped down, minimal import way to communicate with server"""
 
-import json
+import hashlib
 import os
-from typing import Optional, Tuple, Union
+import threading
+from typing import Dict, List, Optional, Tuple, Union
 from http.client import HTTPConnection, HTTPResponse, HTTPSConnection
 from urllib.parse import urlparse
 
 from . import __version__
 from .config import logger
+from .utils import json_dumps, json_loads
 
 ETResponse = Tuple[int, Union[dict, str]]  # status code, body
 
@@ -17,6 +19,15 @@ TIMEOUT_RESPONSE = (
     {"data": None, "errors": [{"message": "Connection to server timed out."}]},
 )
 UNAVAIL_RESPONSE = (503, {"data": None, "errors": [{"message": "Could not connect to server."}]})
+PERSISTED_QUERY_ERRORS = ("PersistedQueryNotFound", "PersistedQueryNotSupported")
+# endpoints that do not support automatic persisted queries
+_APQ_UNSUPPORTED = set()
+
+# idle keep-alive connections of this process, keyed by (scheme, netloc)
+MAX_IDLE_CONNECTIONS = 4
+_POOL: Dict[Tuple[str, str], List[HTTPConnection]] = {}
+_POOL_LOCK = threading.Lock()
+_POOL_PID = os.getpid()
 
 
 def request(
@@ -26,26 +37,62 @@ def request(
     timeout: float = None,
     method: str = "POST",
     chunk_size: int = None,
+    persisted: bool = False,
+) -> ETResponse:
+    """
+    Send a request to `url`, optionally with a graphql `query`.
+
+    If `persisted` and the `MIGAS_PERSISTED_QUERIES` environment variable is set, only the hash
+    of the query is sent at first, following the Automatic Persisted Queries protocol. The full
+    query is sent if the server has not yet registered it. This is only worthwhile for queries
+    that are repeated verbatim.
+    """
+    if not query:
+        return _request(url, None, timeout, method, chunk_size)
+    if not (persisted and os.getenv("MIGAS_PERSISTED_QUERIES")) or url in _APQ_UNSUPPORTED:
+        return _request(url, {"query": query}, timeout, method, chunk_size)
+
+    extensions = {
+        "persistedQuery": {
+            "version": 1,
+            "sha256Hash": hashlib.sha256(query.encode("utf-8")).hexdigest(),
+        },
+    }
+    status, body = _request(url, {"extensions": extensions}, timeout, method, chunk_size)
+    if (status, body) in (TIMEOUT_RESPONSE, UNAVAIL_RESPONSE):
+        return status, body
+    error = _persisted_query_error(body)
+    if error is None:
+        if status < 400 and isinstance(body, dict) and isinstance(body.get("data"), dict):
+            return status, body
+        # servers without APQ support reject hash-only requests in their own way
+        error = "PersistedQueryNotSupported"
+    if error == "PersistedQueryNotSupported":
+        _APQ_UNSUPPORTED.add(url)
+    return _request(url, {"query": query, "extensions": extensions}, timeout, method, chunk_size)
+
+
+def _request(
+    url: str,
+    payload: Optional[dict],
+    timeout: Optional[float],
+    method: str,
+    chunk_size: Optional[int],
 ) -> ETResponse:
     purl = urlparse(url)
-    # TODO: 3.10 - Replace with match/case
-    if purl.scheme == 'https':
-        Connection = HTTPSConnection
-    elif purl.scheme == 'http':
-        Connection = HTTPConnection
-    else:
+    if purl.scheme not in ('https', 'http'):
         raise ValueError("URL scheme not supported")
 
     timeout = timeout or float(os.getenv("MIGAS_TIMEOUT", DEFAULT_TIMEOUT))
-    conn = Connection(purl.netloc, timeout=timeout)
+    conn, reused = _acquire_connection(purl.scheme, purl.netloc, timeout)
     headers = {
         'User-Agent': f'migas-client/{__version__}',
         'Accept-Encoding': 'gzip, deflate',
         'Accept': '*/*',
     }
     body = None
-    if query:
-        body = json.dumps({"query": query}).encode("utf-8")
+    if payload:
+        body = json_dumps(payload).encode("utf-8")
         headers.update(
             {
                 'Content-Length': len(body),
@@ -53,11 +100,18 @@ def request(
             }
         )
 
+    keep_alive = False
     try:
-        conn.request(method, purl.path, body=body, headers=headers)
-        response = conn.getresponse()
-        encoding = response.headers.get('content-encoding')
-        body = _read_response(response, encoding, chunk_size)
+        try:
+            response, body = _exchange(conn, method, purl.path, body, headers, chunk_size)
+        except ConnectionError:
+            if not reused:
+                raise
+            # the server may have closed the idle connection, retry with a new one
+            conn.close()
+            conn, _ = _acquire_connection(purl.scheme, purl.netloc, timeout, reuse=False)
+            response, body = _exchange(conn, method, purl.path, body, headers, chunk_size)
+        keep_alive = not response.will_close
     except TimeoutError:
         return TIMEOUT_RESPONSE
     except ConnectionError:
@@ -71,16 +125,83 @@ def request(
         else:
             return UNAVAIL_RESPONSE
     finally:
-        conn.close()
+        if keep_alive:
+            _release_connection(purl.scheme, purl.netloc, conn)
+        else:
+            conn.close()
 
     if body and response.headers.get("content-type").startswith("application/json"):
-        body = json.loads(body)
+        body = json_loads(body)
 
     if not response.headers.get("X-Backend-Server"):
         logger.warning("migas server is incorrectly configured.")
     return response.status, body
 
 
+def _acquire_connection(
+    scheme: str, netloc: str, timeout: float, reuse: bool = True
+) -> Tuple[HTTPConnection, bool]:
+    """
+    Return a connection to `netloc`, and whether it is an idle pooled connection.
+
+    Pooled connections are discarded if the process has been forked.
+    """
+    global _POOL_PID
+
+    conn = None
+    if reuse:
+        with _POOL_LOCK:
+            if _POOL_PID != os.getpid():
+                _POOL.clear()
+                _POOL_PID = os.getpid()
+            idle = _POOL.get((scheme, netloc))
+            if idle:
+                conn = idle.pop()
+
+    if conn is None:
+        Connection = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return Connection(netloc, timeout=timeout), False
+
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+    return conn, True
+
+
+def _release_connection(scheme: str, netloc: str, conn: HTTPConnection) -> None:
+    """Return a connection to the pool, to be reused by later requests."""
+    with _POOL_LOCK:
+        idle = _POOL.setdefault((scheme, netloc), [])
+        if _POOL_PID == os.getpid() and len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def _exchange(
+    conn: HTTPConnection,
+    method: str,
+    path: str,
+    body: Optional[bytes],
+    headers: dict,
+    chunk_size: Optional[int],
+) -> Tuple[HTTPResponse, str]:
+    """Send a request over `conn`, and read the entire response."""
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    encoding = response.headers.get('content-encoding')
+    return response, _read_response(response, encoding, chunk_size)
+
+
+def _persisted_query_error(body: Union[dict, str]) -> Optional[str]:
+    """Return the persisted query error reported by the server, if any."""
+    if isinstance(body, dict):
+        for error in body.get("errors") or ():
+            if error.get("message") in PERSISTED_QUERY_ERRORS:
+                return error["message"]
+    return None
+
+
 def _read_response(
     response: HTTPResponse,
     encoding: Optional[str] = None,
@@ -14,3 +14,38 @@ def setup_migas():
 
     assert migas.config.Config._is_setup
     return migas.config.Config._is_setup
+
+
+class MockServer:
+    """Stand-in for `migas.request.request`, recording each request sent to the server."""
+
+    def __init__(self):
+        self.requests = []
+        self.respond = lambda query: (200, {'data': {}})
+
+    @property
+    def queries(self) -> list:
+        return [query for query, _ in self.requests]
+
+    def request(self, url, *, query=None, **kwargs):
+        self.requests.append((query, kwargs))
+        return self.respond(query)
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    """
+    Send operations to a `MockServer`, whose `respond(query)` returns the (status, body) reply.
+
+    Cached operation responses are cleared before and after the test.
+    """
+    from migas import operations
+
+    server = MockServer()
+    monkeypatch.setattr(operations, 'request', server.request)
+    monkeypatch.setattr(migas.config.Config, '_is_setup', True)
+    operations.check_project.cache_clear()
+    operations.get_usage.cache_clear()
+    yield server
+    operations.check_project.cache_clear()
+    operations.get_usage.cache_clear()
@@ -121,3 +121,16 @@ def test_logger(monkeypatch):
         m.setenv("MIGAS_LOG_LEVEL", "INFO")
         config._init_logger()
         assert logger.level == 20
+
+
+def test_fingerprint_snapshot():
+    config.Config.init(user_id='00000000-0000-0000-0000-000000000000')
+    fingerprint = config._fingerprint()
+    assert fingerprint['user_id'] == '00000000-0000-0000-0000-000000000000'
+    assert config._fingerprint() is fingerprint
+
+    # reinitializing the config refreshes the snapshot
+    config.Config.init(user_id='11111111-1111-1111-1111-111111111111')
+    assert config._fingerprint() is not fingerprint
+    assert config._fingerprint()['user_id'] == '11111111-1111-1111-1111-111111111111'
+    config.Config._reset()
@@ -1,13 +1,26 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 from datetime import timedelta
 from datetime import timezone as tz
+import json
+import os
+import sys
+import threading
 import time
 
 from looseversion import LooseVersion
 import pytest
 
-from migas import __version__
+from migas import __version__, operations
+from migas.config import Config, _fingerprint
 from migas.operations import (
+    AddBreadcrumb,
+    AddProject,
+    CheckProject,
+    GetUsage,
+    _filter_response,
+    _format_text,
     add_breadcrumb,
     add_project,
     check_project,
@@ -16,8 +29,8 @@ from migas.operations import (
 
 from .utils import do_server_tests
 
-# skip all tests in module if server is not available
-pytestmark = pytest.mark.skipif(not do_server_tests, reason="Local server not found")
+# skip tests if server is not available
+needs_server = pytest.mark.skipif(not do_server_tests, reason="Local server not found")
 
 test_project = 'nipreps/migas-py'
 today = dt.now(tz.utc)
@@ -25,6 +38,54 @@ future = (today + timedelta(days=2)).strftime('%Y-%m-%d')
 today = today.strftime('%Y-%m-%d')
 
 
+@pytest.fixture
+def fingerprint(monkeypatch):
+    for attr in Config._telemetry_attrs:
+        monkeypatch.setattr(Config, attr, None)
+    monkeypatch.setattr(Config, 'user_id', 'u-1')
+    monkeypatch.setattr(Config, 'platform', 'linux')
+    monkeypatch.setattr(Config, 'is_ci', False)
+    _fingerprint.cache_clear()
+    yield
+    _fingerprint.cache_clear()
+
+
+@pytest.mark.parametrize(
+    'operation,kwargs,expected',
+    [
+        (
+            AddBreadcrumb,
+            {'project': 'a/b', 'project_version': '1.0'},
+            'mutation{add_breadcrumb(project:"a/b",project_version:"1.0",'
+            'ctx:{user_id:"u-1",platform:"linux",is_ci:false},proc:{}){success}}',
+        ),
+        (
+            AddBreadcrumb,
+            {'project': 'a/b', 'project_version': '1.0', 'status': 'C', 'error_desc': 'x "y"'},
+            'mutation{add_breadcrumb(project:"a/b",project_version:"1.0",'
+            'ctx:{user_id:"u-1",platform:"linux",is_ci:false},'
+            'proc:{status:C,error_desc:"x \\"y\\""}){success}}',
+        ),
+        (
+            CheckProject,
+            {'project': 'a/b', 'project_version': '1.0', 'is_ci': True},
+            'query{check_project(project:"a/b",project_version:"1.0",is_ci:true)'
+            '{success,flagged,latest,message}}',
+        ),
+        (
+            GetUsage,
+            {'project': 'a/b', 'start': '2022-01-01', 'end': None, 'unique': False},
+            'query{get_usage(project:"a/b",start:"2022-01-01",end:null,unique:false)}',
+        ),
+    ],
+)
+def test_generate_query(fingerprint, operation, kwargs, expected):
+    assert operation.generate_query(**kwargs) == expected
+    # subsequent queries are consistent
+    assert operation.generate_query(**kwargs) == expected
+
+
+@needs_server
 def test_operations(setup_migas):
     _test_add_breakcrumb()
     # add delay to ensure server has updated
@@ -64,6 +125,7 @@ def _test_get_usage():
     assert res['hits'] == 0
 
 
+@needs_server
 def test_add_project(setup_migas):
     res = add_project(test_project, __version__)
     assert res['success'] is True
@@ -83,6 +145,7 @@ def test_add_project(setup_migas):
     assert res['latest_version'] is None
 
 
+@needs_server
 def test_check_project(setup_migas):
     res = check_project(test_project, __version__)
     assert res['success'] is True
@@ -92,3 +155,201 @@ def test_check_project(setup_migas):
     assert v >= latest
     assert res['flagged'] is False
     assert res['message'] == ''
+
+
+def test_batched_breadcrumbs(fingerprint, mock_server, monkeypatch):
+    def _respond(query):
+        n = query.count('add_breadcrumb(')
+        return 200, {'data': {f'q{i}': {'success': True} for i in range(n)}}
+
+    mock_server.respond = _respond
+    monkeypatch.setenv('MIGAS_BATCH', '1')
+
+    for i in range(3):
+        assert add_breadcrumb(test_project, f'0.{i}') == {'success': True}
+    operations._breadcrumbs.flush()
+
+    sent = mock_server.queries
+    assert ''.join(sent).count('add_breadcrumb(') == 3
+    assert len(sent) < 3
+    assert sent[0].startswith('mutation{q0:add_breadcrumb(project:"nipreps/migas-py"')
+
+
+def test_async_operations(mock_server):
+    mock_server.respond = lambda query: (
+        200,
+        {'data': {'check_project': {'success': True, 'query': query}}},
+    )
+
+    res = asyncio.run(operations.check_project_async(test_project, '0.1'))
+    assert res['success'] is True
+    assert res['query'].startswith('query{check_project(project:"nipreps/migas-py"')
+
+
+@pytest.mark.parametrize(
+    'val',
+    ['nipreps/migas-py', '', 'a "quote"', 'back\\slash', 'new\nline', 'tab\t', 'ünï', 5, None],
+)
+def test_format_text(val):
+    assert json.loads(_format_text(val)) == val
+    if isinstance(val, str) and val.isascii() and val.isprintable():
+        assert _format_text(val) == json.dumps(val)
+
+
+def test_filter_response():
+    res = _filter_response({'data': {'get_usage': {'success': True}}}, 'get_usage')
+    assert res == {'success': True}
+
+    error = {'data': None, 'errors': [{'message': 'Invalid status'}]}
+    res = _filter_response(error, 'add_project', AddProject.error_response)
+    assert res['success'] is False
+    assert res['message'] == 'Invalid status'
+    # the operation's default response is left untouched
+    assert AddProject.error_response['message'] == operations.ERROR
+
+    res = _filter_response('Internal Server Error', 'get_usage')
+    assert res == {'success': False, 'message': operations.ERROR}
+
+
+def test_cached_responses(mock_server):
+    def _respond(query):
+        success = 'madeup' not in query
+        hits = len(mock_server.requests)
+        return 200, {'data': {'get_usage': {'success': success, 'hits': hits}}}
+
+    mock_server.respond = _respond
+
+    res = get_usage(test_project, start=today)
+    assert res['hits'] == 1
+    # repeated calls are served from the cache
+    res['hits'] = 100
+    assert get_usage(test_project, start=today)['hits'] == 1
+    assert len(mock_server.requests) == 1
+    # but different inputs are not
+    assert get_usage(test_project, start=today, unique=True)['hits'] == 2
+
+    # unsuccessful responses are not cached
+    get_usage('my/madeup-project', start=today)
+    get_usage('my/madeup-project', start=today)
+    assert len(mock_server.requests) == 4
+
+
+def test_cached_responses_threaded(mock_server):
+    mock_server.respond = lambda query: (200, {'data': {'get_usage': {'success': True}}})
+    # switch threads as often as possible
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        # every call scans the cache for expired entries while other threads insert
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [pool.submit(get_usage, test_project, start=str(i)) for i in range(2000)]
+            assert all(f.result()['success'] for f in futures)
+    finally:
+        sys.setswitchinterval(interval)
+
+
+def test_invalid_query_args():
+    with pytest.raises(TypeError):
+
+        class BadOperation(operations.Operation):
+            operation_type = 'query'
+            operation_name = 'bad'
+            query_args = {'project': str}
+
+
+def test_telemetry_disabled(mock_server, monkeypatch):
+    def _fail(*args, **kwargs):
+        raise AssertionError('query should not be generated')
+
+    monkeypatch.setattr(AddBreadcrumb, 'generate_query', _fail)
+    monkeypatch.setenv('MIGAS_OPTOUT', '1')
+
+    res = add_breadcrumb(test_project, __version__)
+    assert res['success'] is False
+    assert res['errors'][0]['message'] == 'migas telemetry is disabled.'
+    assert not mock_server.requests
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="Requires os.fork")
+def test_batched_breadcrumbs_fork(fingerprint, mock_server, monkeypatch):
+    sent = threading.Event()
+
+    def _respond(query):
+        sent.set()
+        time.sleep(0.5)
+        return 200, {'data': {'q0': {'success': True}}}
+
+    mock_server.respond = _respond
+    monkeypatch.setenv('MIGAS_BATCH', '1')
+
+    add_breadcrumb(test_project, __version__)
+    # wait for the background thread to pick up the breadcrumb
+    assert sent.wait(timeout=5)
+    pid = os.fork()
+    if pid == 0:
+        # the child does not wait on queries in flight from the parent
+        operations._breadcrumbs.flush()
+        os._exit(0)
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            break
+        time.sleep(0.05)
+    else:
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+        pytest.fail("forked child did not exit")
+    operations._breadcrumbs.flush()
+
+
+@pytest.mark.parametrize('failure', ['timeout', 'invalid'])
+def test_batched_breadcrumbs_failure(fingerprint, mock_server, monkeypatch, caplog, failure):
+    from migas.request import TIMEOUT_RESPONSE
+
+    def _respond(query):
+        if failure == 'timeout':
+            return TIMEOUT_RESPONSE
+        if query.count('add_breadcrumb(') > 1:
+            return 400, {'data': None, 'errors': [{'message': 'Invalid status'}]}
+        return 200, {'data': {'add_breadcrumb': {'success': True}}}
+
+    mock_server.respond = _respond
+    monkeypatch.setenv('MIGAS_BATCH', '1')
+    # queue everything before the background thread can send
+    monkeypatch.setattr(operations._breadcrumbs, '_thread', threading.current_thread())
+
+    with caplog.at_level('WARNING', logger='migas-py'):
+        for i in range(10):
+            add_breadcrumb(test_project, f'0.{i}')
+        operations._breadcrumbs.flush()
+
+    assert not caplog.records
+    if failure == 'timeout':
+        # unreachable servers are not retried per breadcrumb
+        assert len(mock_server.requests) == 1
+    else:
+        # rejected batches are resent individually
+        assert len(mock_server.requests) == 11
+
+
+def test_cached_null_response(mock_server):
+    mock_server.respond = lambda query: (
+        200,
+        {'data': {'check_project': None}, 'errors': [{'message': 'Unknown project'}]},
+    )
+
+    assert check_project('my/madeup-project', '0.1') is None
+    # null responses are not cached
+    assert check_project('my/madeup-project', '0.1') is None
+    assert len(mock_server.requests) == 2
+
+
+def test_persisted_operations(fingerprint, mock_server):
+    add_breadcrumb(test_project, __version__)
+    check_project(test_project, __version__)
+
+    persisted = {
+        query.split('(')[0]: kwargs['persisted'] for query, kwargs in mock_server.requests
+    }
+    assert persisted == {'mutation{add_breadcrumb': False, 'query{check_project': True}
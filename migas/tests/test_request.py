@@ -34,3 +34,90 @@ def test_timeout(monkeypatch):
     status, res = request(GET_URL, method="GET")
     assert status == 200
     assert res
+
+
+def test_persisted_queries(monkeypatch):
+    from migas import request as req
+
+    payloads = []
+    registered = set()
+
+    def _request(url, payload, *args):
+        payloads.append(payload)
+        if 'query' not in payload and url == GET_URL:
+            # servers without APQ support
+            return 400, 'No GraphQL query found in the request'
+        if 'extensions' not in payload:
+            return 200, {'data': {'sent': payload['query']}}
+        query_hash = payload['extensions']['persistedQuery']['sha256Hash']
+        if 'query' in payload:
+            registered.add(query_hash)
+        elif query_hash not in registered:
+            return 200, {'data': None, 'errors': [{'message': 'PersistedQueryNotFound'}]}
+        return 200, {'data': {'ok': True}}
+
+    monkeypatch.setattr(req, '_request', _request)
+    monkeypatch.setattr(req, '_APQ_UNSUPPORTED', set())
+    monkeypatch.setenv('MIGAS_PERSISTED_QUERIES', '1')
+
+    # first request registers the query
+    assert request(POST_URL, query='query{ok}', persisted=True) == (200, {'data': {'ok': True}})
+    assert len(payloads) == 2
+    assert payloads[1]['query'] == 'query{ok}'
+
+    # subsequent requests only send the hash
+    assert request(POST_URL, query='query{ok}', persisted=True) == (200, {'data': {'ok': True}})
+    assert len(payloads) == 3
+    assert 'query' not in payloads[2]
+
+    # requests not marked as persisted send the full query
+    assert request(POST_URL, query='mutation{ok}') == (200, {'data': {'sent': 'mutation{ok}'}})
+    assert len(payloads) == 4
+
+    # unsupported servers receive the full query, and are not sent hashes again
+    assert request(GET_URL, query='query{ok}', persisted=True) == (200, {'data': {'ok': True}})
+    assert len(payloads) == 6
+    res = request(GET_URL, query='query{ok}', persisted=True)
+    assert res == (200, {'data': {'sent': 'query{ok}'}})
+    assert len(payloads) == 7
+    assert 'extensions' not in payloads[6]
+
+
+def test_connection_reuse():
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    clients = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            clients.append(self.client_address)
+            content = b'{"data": {"ok": true}}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('X-Backend-Server', 'migas')
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/graphql'
+    try:
+        for _ in range(3):
+            status, res = request(url, query='query{ok}')
+            assert status == 200
+            assert res == {'data': {'ok': True}}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(clients) == 3
+    # all requests were sent over the same connection
+    assert len(set(clients)) == 1
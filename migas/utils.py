@@ -1,8 +1,32 @@
 """Utility functions"""
+import json
 import platform
 import sys
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(obj) -> str:
+    """Serialize `obj` to a JSON string, using `orjson` if available."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            # e.g. integers exceeding 64 bits
+            pass
+    return json.dumps(obj)
+
+
+def json_loads(data):
+    """Deserialize a JSON string or bytes, using `orjson` if available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 def is_container():
     root = Path('/')